@@ -4,13 +4,22 @@ import gspread
 from google.oauth2.service_account import Credentials
 import json
 import random
+from itertools import islice
+from collections import defaultdict
 import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 from datetime import datetime, timedelta
 import cloudinary
 import cloudinary.uploader
 
+POST_FIELDS = ('text', 'posted', 'image_path', 'thread_id', 'thread_order')
+
 class ThreadsBot:
+    _VIDEO_EXTS = ('.mp4', '.mov', '.avi', '.mkv', '.flv', '.wmv')
+    
     def __init__(self):
         """初期化"""
         print("🚀 Threads Bot 処理を開始します...")
@@ -30,6 +39,34 @@ class ThreadsBot:
             api_secret=os.environ.get('CLOUDINARY_API_SECRET')
         )
         
+        # Threads API用HTTPセッション（接続を使い回してTLSハンドシェイクを削減）
+        self.http = requests.Session()
+        self.http.mount('https://', HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=8,
+            max_retries=Retry(
+                total=5,
+                backoff_factor=1,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["GET", "POST"],
+                raise_on_status=False
+            )
+        ))
+        
+        # threads_publishは冪等ではないため、429（未処理が確実）のみ再試行する
+        # 5xxや読み取りエラーは公開済みの可能性があり、再送すると重複投稿になる
+        self.publish_http = requests.Session()
+        self.publish_http.mount('https://', HTTPAdapter(
+            max_retries=Retry(
+                total=5,
+                read=0,
+                backoff_factor=1,
+                status_forcelist=[429],
+                allowed_methods=["POST"],
+                raise_on_status=False
+            )
+        ))
+        
         # Google Sheets接続
         self._connect_sheets()
         
@@ -62,18 +99,29 @@ class ThreadsBot:
             print(f"❌ エラー: スプレッドシート接続失敗: {e}")
             sys.exit(1)
     
+    def _with_backoff(self, func, *args, max_attempts=5, **kwargs):
+        """Sheets APIの429エラー時に指数バックオフで再試行"""
+        for attempt in range(max_attempts):
+            try:
+                return func(*args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                if e.response.status_code != 429 or attempt == max_attempts - 1:
+                    raise
+                wait = 2 ** attempt
+                print(f"  ⏳ Sheets APIレート制限、{wait}秒後に再試行します...")
+                time.sleep(wait)
+    
     def _load_token_info(self):
         """Configシートからトークン情報を読み込む"""
         try:
-            self.access_token = self.config_sheet.cell(1, 1).value
-            self.user_id = self.config_sheet.cell(1, 2).value
-            expires_str = self.config_sheet.cell(1, 3).value
+            # 1行目(A1:C1)を1回のリクエストでまとめて取得
+            row = self._with_backoff(self.config_sheet.row_values, 1)
+            row += [None] * (3 - len(row))
+            self.access_token, self.user_id, expires_str = row[0], row[1], row[2]
             
             if expires_str:
-                try:
-                    self.expires_at = datetime.fromisoformat(expires_str.replace(' ', 'T'))
-                except:
-                    self.expires_at = datetime.strptime(expires_str, '%Y-%m-%d %H:%M:%S')
+                # 保存時は常にISO形式（'YYYY-MM-DD HH:MM:SS'形式もそのまま解釈可能）
+                self.expires_at = datetime.fromisoformat(expires_str)
             else:
                 self.expires_at = datetime.now() + timedelta(days=60)
             
@@ -85,16 +133,20 @@ class ThreadsBot:
     def _save_token_info(self):
         """トークン情報をConfigシートに保存"""
         try:
-            self.config_sheet.update_cell(1, 1, self.access_token)
-            self.config_sheet.update_cell(1, 2, self.user_id)
-            self.config_sheet.update_cell(1, 3, self.expires_at.isoformat())
+            self._with_backoff(
+                self.config_sheet.update,
+                range_name='A1:C1',
+                values=[[self.access_token, self.user_id, self.expires_at.isoformat(timespec='seconds')]],
+                value_input_option='USER_ENTERED'
+            )
             print("💾 トークン情報を保存しました")
         except Exception as e:
             print(f"⚠️ トークン保存エラー: {e}")
     
     def refresh_token_if_needed(self):
         """トークンの有効期限チェック＆自動リフレッシュ"""
-        days_until_expiry = (self.expires_at - datetime.now()).days
+        now = datetime.now()
+        days_until_expiry = (self.expires_at - now).days
         
         if days_until_expiry <= 7:
             print(f"⚠️ トークン有効期限まで残り{days_until_expiry}日")
@@ -106,12 +158,12 @@ class ThreadsBot:
                 "access_token": self.access_token
             }
             
-            response = requests.get(url, params=params)
+            response = self.http.get(url, params=params)
             
             if response.status_code == 200:
                 data = response.json()
                 self.access_token = data['access_token']
-                self.expires_at = datetime.now() + timedelta(seconds=data['expires_in'])
+                self.expires_at = now + timedelta(seconds=data['expires_in'])
                 self._save_token_info()
                 print(f"✅ トークンリフレッシュ完了！新しい有効期限: {self.expires_at.strftime('%Y-%m-%d')}")
                 return True
@@ -125,53 +177,81 @@ class ThreadsBot:
     
     def is_video_file(self, file_path):
         """ファイルが動画かどうかを判定"""
-        video_extensions = ['.mp4', '.mov', '.avi', '.mkv', '.flv', '.wmv']
-        file_ext = os.path.splitext(file_path.lower())[1]
-        return file_ext in video_extensions
+        return file_path.lower().endswith(ThreadsBot._VIDEO_EXTS)
     
-    def upload_media_to_cloudinary(self, media_path):
-        """画像または動画をCloudinaryにアップロード"""
+    def upload_media_to_cloudinary(self, media_path, log=print):
+        """画像または動画をCloudinaryにアップロード
+        
+        logにはメッセージの出力先を渡せる（バックグラウンド実行時のバッファ用）
+        """
         if not os.path.exists(media_path):
-            print(f"  ⚠️ ファイルが見つかりません: {media_path}")
+            log(f"  ⚠️ ファイルが見つかりません: {media_path}")
             return None, None
         
         is_video = self.is_video_file(media_path)
         media_type = "動画" if is_video else "画像"
         
-        print(f"  📤 Cloudinaryに{media_type}をアップロード中: {media_path}")
+        log(f"  📤 Cloudinaryに{media_type}をアップロード中: {media_path}")
         
         try:
-            upload_params = {}
             if is_video:
-                upload_params['resource_type'] = 'video'
-            
-            result = cloudinary.uploader.upload(media_path, **upload_params)
+                # 動画はチャンク分割でアップロードし、メモリ使用量をチャンクサイズ程度に抑える
+                result = cloudinary.uploader.upload_large(
+                    media_path,
+                    resource_type='video',
+                    chunk_size=6_000_000,
+                    eager_async=True
+                )
+            else:
+                result = cloudinary.uploader.upload(media_path)
             url = result['secure_url']
-            print(f"  ✅ アップロード成功: {url}")
+            log(f"  ✅ アップロード成功: {url}")
             return url, 'VIDEO' if is_video else 'IMAGE'
         except Exception as e:
-            print(f"  ❌ アップロード失敗: {e}")
+            log(f"  ❌ アップロード失敗: {e}")
             return None, None
     
-    def has_valid_media(self, media_path):
-        """メディアパスが有効かどうかを厳格にチェック"""
-        if media_path is None:
-            return False
-        if media_path == "":
-            return False
-        if not isinstance(media_path, str):
-            media_path = str(media_path)
-        media_path = media_path.strip()
-        if len(media_path) == 0:
-            return False
-        return True
+    def _upload_in_background(self, media_path):
+        """バックグラウンド用: ログをバッファしつつアップロード"""
+        lines = []
+        result = self.upload_media_to_cloudinary(media_path, log=lines.append)
+        return result, lines
+    
+    def _take_upload(self, upload):
+        """先行アップロードの完了を待ち、バッファしたログを出力して結果を返す"""
+        result, lines = upload.result()
+        for line in lines:
+            print(line)
+        return result
     
-    def get_unposted_groups(self, records):
-        """未投稿データをグループ化"""
-        groups = {}
+    def _fetch_posts(self):
+        """Postsシートから必要な列(A:F)のみ取得して辞書のリストに変換"""
+        raw = self._with_backoff(self.posts_sheet.get, 'A1:F')
+        if not raw:
+            return []
+        
+        header, rows = raw[0], raw[1:]
+        # 必要な列の位置だけを事前に求めておく
+        columns = [(key, header.index(key)) for key in POST_FIELDS if key in header]
+        
+        records = []
+        for row in rows:
+            record = dict.fromkeys(POST_FIELDS, '')
+            for key, col in columns:
+                if col < len(row):
+                    record[key] = row[col]
+            records.append(record)
+        return records
+    
+    def get_unposted_groups(self, records, ignore_posted=False):
+        """未投稿データをグループ化
+        
+        ignore_posted=Trueの場合はpostedの値に関わらず全件を未投稿として扱う
+        """
+        groups = defaultdict(list)
         
         for i, post in enumerate(records):
-            if str(post.get('posted', '')).upper() != 'TRUE':
+            if ignore_posted or post.get('posted') not in ('TRUE', 'True', 'true'):
                 post['row_index'] = i + 2
                 
                 thread_id_val = str(post.get('thread_id', '')).strip()
@@ -181,22 +261,83 @@ class ThreadsBot:
                 else:
                     group_key = f"SINGLE_{i}"
                 
-                if group_key not in groups:
-                    groups[group_key] = []
-                
                 groups[group_key].append(post)
         
         return groups
     
-    def post_to_threads(self, text, media_path=None):
-        """Threadsに投稿（画像または動画）"""
+    def _wait_container_ready(self, container_id, timeout, fallback):
+        """コンテナのstatusをポーリングし、FINISHEDになるまで待機
+        
+        ステータスが取得できない場合はfallback秒（従来の固定待機）を上限に待つ
+        """
+        url = f"https://graph.threads.net/v1.0/{container_id}"
+        params = {
+            "fields": "status,error_message",
+            "access_token": self.access_token
+        }
+        started = time.monotonic()
+        deadline = started + timeout
+        delay = 1
+        
+        while True:
+            response = self.http.get(url, params=params)
+            try:
+                data = response.json() if response.status_code == 200 else {}
+            except ValueError:
+                data = {}
+            status = data.get('status')
+            if status is None:
+                print(f"  ⚠️ コンテナステータス取得失敗: {response.text}")
+                time.sleep(max(0, fallback - (time.monotonic() - started)))
+                return True
+            if status == "FINISHED":
+                return True
+            if status in ("ERROR", "EXPIRED"):
+                print(f"  ❌ コンテナ処理失敗: {status} {data.get('error_message', '')}")
+                return False
+            
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # タイムアウト時は従来通り公開を試みる
+                print(f"  ⚠️ {timeout}秒以内に処理完了を確認できませんでした")
+                return True
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 3)
+    
+    def _mark_posted(self, row_index, thread_id):
+        """投稿済みフラグ(C列)とThread ID(F列)の更新を予約"""
+        self.pending_updates.append({'range': f'C{row_index}', 'values': [['TRUE']]})
+        self.pending_updates.append({'range': f'F{row_index}', 'values': [[thread_id]]})
+    
+    def _flush_posted(self):
+        """予約済みの更新を1回のbatch_updateでシートに反映"""
+        if not self.pending_updates:
+            return
+        try:
+            # update_cellと同じくUSER_ENTEREDで書き込み、チェックボックス/真偽値の書式を維持
+            self._with_backoff(
+                self.posts_sheet.batch_update,
+                self.pending_updates,
+                value_input_option='USER_ENTERED'
+            )
+            print(f"  💾 シート更新完了（{len(self.pending_updates) // 2}件）")
+            self.pending_updates = []
+        except Exception as e:
+            # 記録できなかった行は次回再投稿されるため、異常終了してActions上で検知できるようにする
+            rows = [u['range'][1:] for u in self.pending_updates if u['range'].startswith('C')]
+            print(f"  ❌ エラー: シート更新失敗（未記録の行: {', '.join(rows)}）: {e}")
+            sys.exit(1)
+    
+    def post_to_threads(self, text, media_path=None, upload=None):
+        """Threadsに投稿（画像または動画）
+        
+        media_pathは前後の空白を除去済みの文字列、メディアなしの場合はNoneを渡す
+        uploadにはアップロード済み（または実行中）のFutureを渡せる
+        """
         media_url = None
         media_type = None
         
-        # メディアパスの厳格なチェック
-        if self.has_valid_media(media_path):
-            media_path = str(media_path).strip()
-            
+        if media_path:
             if media_path.startswith('http'):
                 # 公開URLの場合
                 media_url = media_path
@@ -207,8 +348,10 @@ class ThreadsBot:
                 else:
                     media_type = "IMAGE"
                     print(f"  🌐 公開画像URL使用: {media_url}")
+            # ローカルファイルの場合
+            elif upload is not None:
+                media_url, media_type = self._take_upload(upload)
             else:
-                # ローカルファイルの場合
                 media_url, media_type = self.upload_media_to_cloudinary(media_path)
         
         url = f"https://graph.threads.net/v1.0/{self.user_id}/threads"
@@ -230,7 +373,7 @@ class ThreadsBot:
             params["media_type"] = "TEXT"
             print(f"  📝 テキストのみ投稿")
         
-        response = requests.post(url, data=params)
+        response = self.http.post(url, data=params)
         
         if response.status_code != 200:
             print(f"  ❌ コンテナ作成失敗: {response.text}")
@@ -241,11 +384,13 @@ class ThreadsBot:
         
         # 動画の場合は処理時間が長いので待機
         if media_type == "VIDEO":
-            print("  ⏳ 動画処理中（最大30秒待機）...")
-            time.sleep(30)
+            print("  ⏳ 動画処理中（最大60秒待機）...")
+            if not self._wait_container_ready(container_id, timeout=60, fallback=30):
+                return None
         elif media_url:
             print("  ⏳ 画像処理中...")
-            time.sleep(5)
+            if not self._wait_container_ready(container_id, timeout=15, fallback=5):
+                return None
         
         publish_url = f"https://graph.threads.net/v1.0/{self.user_id}/threads_publish"
         publish_params = {
@@ -253,7 +398,7 @@ class ThreadsBot:
             "access_token": self.access_token
         }
         
-        publish_response = requests.post(publish_url, data=publish_params)
+        publish_response = self.publish_http.post(publish_url, data=publish_params)
         
         if publish_response.status_code == 200:
             thread_id = publish_response.json()['id']
@@ -263,14 +408,16 @@ class ThreadsBot:
             print(f"  ❌ 公開失敗: {publish_response.text}")
             return None
     
-    def post_reply(self, text, reply_to_id, media_path=None):
-        """リプライとして投稿（画像または動画）"""
+    def post_reply(self, text, reply_to_id, media_path=None, upload=None):
+        """リプライとして投稿（画像または動画）
+        
+        media_pathは前後の空白を除去済みの文字列、メディアなしの場合はNoneを渡す
+        uploadにはアップロード済み（または実行中）のFutureを渡せる
+        """
         media_url = None
         media_type = None
         
-        # メディアパスの厳格なチェック
-        if self.has_valid_media(media_path):
-            media_path = str(media_path).strip()
+        if media_path:
             print(f"  📎 リプライにメディアを添付: {media_path}")
             
             if media_path.startswith('http'):
@@ -279,6 +426,8 @@ class ThreadsBot:
                     media_type = "VIDEO"
                 else:
                     media_type = "IMAGE"
+            elif upload is not None:
+                media_url, media_type = self._take_upload(upload)
             else:
                 media_url, media_type = self.upload_media_to_cloudinary(media_path)
         else:
@@ -301,7 +450,7 @@ class ThreadsBot:
         else:
             params["media_type"] = "TEXT"
         
-        response = requests.post(url, data=params)
+        response = self.http.post(url, data=params)
         
         if response.status_code != 200:
             print(f"  ❌ リプライコンテナ作成失敗: {response.text}")
@@ -313,10 +462,12 @@ class ThreadsBot:
         # 動画の場合は待機時間を長く
         if media_type == "VIDEO":
             print("  ⏳ 動画処理中...")
-            time.sleep(30)
+            if not self._wait_container_ready(container_id, timeout=60, fallback=30):
+                return None
         elif media_url:
             print("  ⏳ 画像処理中...")
-            time.sleep(5)
+            if not self._wait_container_ready(container_id, timeout=15, fallback=5):
+                return None
         
         publish_url = f"https://graph.threads.net/v1.0/{self.user_id}/threads_publish"
         publish_params = {
@@ -324,7 +475,7 @@ class ThreadsBot:
             "access_token": self.access_token
         }
         
-        publish_response = requests.post(publish_url, data=publish_params)
+        publish_response = self.publish_http.post(publish_url, data=publish_params)
         
         if publish_response.status_code == 200:
             thread_id = publish_response.json()['id']
@@ -341,7 +492,7 @@ class ThreadsBot:
             sys.exit(1)
         
         try:
-            all_posts = self.posts_sheet.get_all_records()
+            all_posts = self._fetch_posts()
             post_groups = self.get_unposted_groups(all_posts)
             
             if not post_groups:
@@ -349,16 +500,17 @@ class ThreadsBot:
                 row_count = len(all_posts)
                 
                 if row_count > 0:
-                    reset_values = [['FALSE'] for _ in range(row_count)]
-                    self.posts_sheet.update(
+                    # 内側のリストは変更されないので同一オブジェクトの共有で問題ない
+                    reset_values = [['FALSE']] * row_count
+                    self._with_backoff(
+                        self.posts_sheet.update,
                         range_name=f'C2:C{row_count + 1}',
                         values=reset_values
                     )
                     print(">> スプレッドシートをリセットしました。")
                     
-                    for post in all_posts:
-                        post['posted'] = 'FALSE'
-                    post_groups = self.get_unposted_groups(all_posts)
+                    # リセット後は全件が未投稿なので、postedを書き換えずにそのままグループ化
+                    post_groups = self.get_unposted_groups(all_posts, ignore_posted=True)
         
         except Exception as e:
             print(f"❌ エラー: データ読み込み失敗: {e}")
@@ -370,7 +522,7 @@ class ThreadsBot:
         
         print(f"📊 投稿候補のグループ数: {len(post_groups)}")
         
-        selected_group_key = random.choice(list(post_groups.keys()))
+        selected_group_key = next(islice(post_groups, random.randrange(len(post_groups)), None))
         selected_posts = post_groups[selected_group_key]
         
         if "THREAD_" in selected_group_key:
@@ -381,57 +533,81 @@ class ThreadsBot:
         
         previous_thread_id = None
         
-        for idx, post in enumerate(selected_posts):
-            post_text = post['text']
-            media_path = post.get('image_path', '')
-            row_index = post['row_index']
-            
-            print(f"\n{'='*50}")
-            print(f"投稿 {idx+1}/{len(selected_posts)} (行: {row_index})")
-            print(f"テキスト: {post_text[:50]}...")
-            if self.has_valid_media(media_path):
-                print(f"メディア: {media_path}")
-            
-            try:
-                if idx == 0:
-                    thread_id = self.post_to_threads(
-                        post_text,
-                        media_path if self.has_valid_media(media_path) else None
-                    )
-                    
-                    if thread_id:
-                        previous_thread_id = thread_id
-                        self.posts_sheet.update_cell(row_index, 3, 'TRUE')
-                        self.posts_sheet.update_cell(row_index, 6, thread_id)
-                        print(f"  💾 シート更新完了")
-                        time.sleep(3)
-                    else:
-                        print("  ⚠️ 親投稿失敗、このグループをスキップ")
-                        break
+        # メディアパスは行ごとに一度だけ正規化しておく
+        for post in selected_posts:
+            post['media_path'] = str(post.get('image_path', '') or '').strip() or None
+        
+        # 次の投稿のローカルメディアだけを先行アップロードし、Threads側の処理待ちと重ねる
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        uploads = {}
+        
+        self.pending_updates = []
+        
+        try:
+            for idx, post in enumerate(selected_posts):
+                post_text = post['text']
+                media_path = post['media_path']
+                row_index = post['row_index']
                 
-                else:
-                    if not previous_thread_id:
-                        print("  ⚠️ 親投稿IDがないためスキップ")
-                        break
-                    
-                    reply_id = self.post_reply(
-                        post_text,
-                        previous_thread_id,
-                        media_path if self.has_valid_media(media_path) else None
-                    )
+                print(f"\n{'='*50}")
+                print(f"投稿 {idx+1}/{len(selected_posts)} (行: {row_index})")
+                print(f"テキスト: {post_text[:50]}...")
+                if media_path:
+                    print(f"メディア: {media_path}")
+                
+                if idx + 1 < len(selected_posts):
+                    next_post = selected_posts[idx + 1]
+                    next_media = next_post['media_path']
+                    if next_media and not next_media.startswith('http'):
+                        uploads[next_post['row_index']] = self.pool.submit(
+                            self._upload_in_background, next_media
+                        )
+                
+                try:
+                    if idx == 0:
+                        thread_id = self.post_to_threads(
+                            post_text,
+                            media_path,
+                            upload=uploads.get(row_index)
+                        )
+                        
+                        if thread_id:
+                            previous_thread_id = thread_id
+                            self._mark_posted(row_index, thread_id)
+                            print(f"  💾 シート更新を予約")
+                        else:
+                            print("  ⚠️ 親投稿失敗、このグループをスキップ")
+                            break
                     
-                    if reply_id:
-                        self.posts_sheet.update_cell(row_index, 3, 'TRUE')
-                        self.posts_sheet.update_cell(row_index, 6, reply_id)
-                        print(f"  💾 シート更新完了")
-                        time.sleep(3)
                     else:
-                        print("  ⚠️ リプライ投稿失敗")
-                        break
-            
-            except Exception as e:
-                print(f"  ❌ エラー: 投稿処理失敗: {e}")
-                break
+                        if not previous_thread_id:
+                            print("  ⚠️ 親投稿IDがないためスキップ")
+                            break
+                        
+                        reply_id = self.post_reply(
+                            post_text,
+                            previous_thread_id,
+                            media_path,
+                            upload=uploads.get(row_index)
+                        )
+                        
+                        if reply_id:
+                            self._mark_posted(row_index, reply_id)
+                            print(f"  💾 シート更新を予約")
+                        else:
+                            print("  ⚠️ リプライ投稿失敗")
+                            break
+                
+                except Exception as e:
+                    print(f"  ❌ エラー: 投稿処理失敗: {e}")
+                    break
+        finally:
+            try:
+                # 投稿済みの行はまとめて1回で書き込む（途中失敗・例外時も反映）
+                self._flush_posted()
+            finally:
+                # 途中で中断した場合、先行アップロードは最大1件のみ完了を待つ
+                self.pool.shutdown(cancel_futures=True)
         
         print("\n" + "="*50)
         print("🎉 Bot処理が正常に完了しました！")